@@ -0,0 +1,80 @@
+"""Store embeddings as float16
+
+Revision ID: dc2da718d86a
+Revises: 0f04da00799d
+Create Date: 2026-10-15 10:12:41.318274
+
+"""
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "dc2da718d86a"
+down_revision = "0f04da00799d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "enrollments",
+        sa.Column("embedding_f16", sa.LargeBinary(), nullable=True),
+        schema="rekognizer",
+    )
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT id, embedding FROM rekognizer.enrollments")
+    ).fetchall()
+    for id, embedding in rows:
+        connection.execute(
+            sa.text(
+                "UPDATE rekognizer.enrollments SET embedding_f16 = :embedding "
+                "WHERE id = :id"
+            ),
+            {"id": id, "embedding": np.asarray(embedding, dtype=np.float16).tobytes()},
+        )
+
+    op.drop_column("enrollments", "embedding", schema="rekognizer")
+    op.alter_column(
+        "enrollments",
+        "embedding_f16",
+        new_column_name="embedding",
+        nullable=False,
+        schema="rekognizer",
+    )
+
+
+def downgrade():
+    op.alter_column(
+        "enrollments",
+        "embedding",
+        new_column_name="embedding_f16",
+        schema="rekognizer",
+    )
+    op.add_column(
+        "enrollments",
+        sa.Column("embedding", postgresql.ARRAY(sa.Float()), nullable=True),
+        schema="rekognizer",
+    )
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT id, embedding_f16 FROM rekognizer.enrollments")
+    ).fetchall()
+    for id, embedding in rows:
+        connection.execute(
+            sa.text(
+                "UPDATE rekognizer.enrollments SET embedding = :embedding "
+                "WHERE id = :id"
+            ),
+            {
+                "id": id,
+                "embedding": np.frombuffer(embedding, dtype=np.float16).tolist(),
+            },
+        )
+
+    op.drop_column("enrollments", "embedding_f16", schema="rekognizer")
+    op.alter_column("enrollments", "embedding", nullable=False, schema="rekognizer")
@@ -0,0 +1,31 @@
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+EMBEDDING_CACHE_SIZE = 1024
+
+
+class EmbeddingCache:
+    """ LRU cache of face embeddings keyed by the SHA-256 of the image content.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.embeddings = OrderedDict()
+
+    def get(self, digest: str) -> Optional[np.array]:
+        embedding = self.embeddings.get(digest)
+        if embedding is not None:
+            self.embeddings.move_to_end(digest)
+
+        return embedding
+
+    def set(self, digest: str, embedding: np.array):
+        self.embeddings[digest] = embedding
+        self.embeddings.move_to_end(digest)
+        if len(self.embeddings) > self.maxsize:
+            self.embeddings.popitem(last=False)
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE)
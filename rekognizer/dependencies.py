@@ -0,0 +1,58 @@
+from typing import Callable, List, Tuple
+
+import faiss
+import numpy as np
+from eventlet.semaphore import Semaphore
+from nameko.extensions import DependencyProvider
+
+from rekognizer.facenet import EMBEDDING_SIZE
+
+
+class EnrollmentIndex:
+    """ In-memory FAISS index of enrolled embeddings, keyed by user id.
+    Loaded lazily from the database, then kept up to date with enrollment events.
+    """
+
+    def __init__(self):
+        self.index = faiss.IndexIDMap(faiss.IndexFlatL2(EMBEDDING_SIZE))
+        self.is_loaded = False
+        self.lock = Semaphore()
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def _add(self, user_ids: List[int], embeddings: List[List[float]]):
+        self.index.add_with_ids(
+            np.asarray(embeddings, dtype=np.float32),
+            np.asarray(user_ids, dtype=np.int64),
+        )
+
+    def ensure_loaded(self, get_enrollments: Callable[[], Tuple[List[int], np.array]]):
+        with self.lock:
+            if not self.is_loaded:
+                user_ids, embeddings = get_enrollments()
+                if len(user_ids) > 0:
+                    self._add(user_ids, embeddings)
+                self.is_loaded = True
+
+    def add(self, user_ids: List[int], embeddings: List[List[float]]):
+        with self.lock:
+            # Enrollments made before loading are picked up from the database
+            if self.is_loaded:
+                self._add(user_ids, embeddings)
+
+    def search(self, embedding: np.array) -> Tuple[float, int]:
+        distances, user_ids = self.index.search(
+            np.asarray([embedding], dtype=np.float32), 1
+        )
+
+        # FAISS returns squared L2 distances
+        return float(np.sqrt(distances[0][0])), int(user_ids[0][0])
+
+
+class EnrollmentIndexProvider(DependencyProvider):
+    def setup(self):
+        self.enrollment_index = EnrollmentIndex()
+
+    def get_dependency(self, worker_ctx):
+        return self.enrollment_index
@@ -6,6 +6,8 @@ from nameko.exceptions import safe_for_serialization, BadRequest
 from werkzeug import Response
 
 from rekognizer.exceptions import (
+    ImageDownloadTimeoutException,
+    ImageTooLargeException,
     NoFaceException,
     TooManyFacesException,
     UnknownPersonException,
@@ -28,6 +30,8 @@ class CorsHttpRequestHandler(HttpRequestHandler):
         TooManyFacesException: (400, "TOO_MANY_FACE"),
         UnknownPersonException: (400, "UNKNOWN_PERSON"),
         UserDisabledException: (401, "USER_DISABLED"),
+        ImageTooLargeException: (400, "IMAGE_TOO_LARGE"),
+        ImageDownloadTimeoutException: (400, "IMAGE_DOWNLOAD_TIMEOUT"),
     }
 
     def response_from_exception(self, exc):
@@ -12,3 +12,11 @@ class UnknownPersonException(Exception):
 
 class UserDisabledException(Exception):
     pass
+
+
+class ImageTooLargeException(Exception):
+    pass
+
+
+class ImageDownloadTimeoutException(Exception):
+    pass
@@ -1,10 +1,42 @@
+from typing import List
+
 import numpy as np
-from mtcnn.mtcnn import MTCNN
+from batch_face import RetinaFace
+from eventlet import tpool
+
+FACE_DETECTION_THRESHOLD = 0.95
 
-face_detector = MTCNN()
+face_detector = RetinaFace(gpu_id=-1)
 
 
 class FaceDetector:
     @staticmethod
-    def detect_faces(image: np.array):
-        return face_detector.detect_faces(image)
+    def detect_faces_batch(images: List[np.array]) -> List[List[dict]]:
+        """ Detects faces on a list of images, images sharing the same shape go
+        through RetinaFace as a single batch.
+        """
+        batches = {}
+        for index, image in enumerate(images):
+            batches.setdefault(image.shape, []).append(index)
+
+        result = [None] * len(images)
+        for indexes in batches.values():
+            # Run in a native thread so it doesn't block the eventlet hub
+            batch_faces = tpool.execute(
+                face_detector,
+                [images[index] for index in indexes],
+                threshold=FACE_DETECTION_THRESHOLD,
+                cv=False,
+            )
+
+            for index, faces in zip(indexes, batch_faces):
+                # Convert (x1, y1, x2, y2) boxes to the (x, y, width, height) format
+                result[index] = [
+                    {
+                        "box": [int(x1), int(y1), int(x2 - x1), int(y2 - y1)],
+                        "confidence": float(score),
+                    }
+                    for (x1, y1, x2, y2), _, score in faces
+                ]
+
+        return result
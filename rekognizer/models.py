@@ -1,8 +1,9 @@
 import datetime
 
-from sqlalchemy import Column, DateTime, Integer, Float, MetaData
-from sqlalchemy.dialects import postgresql
+import numpy as np
+from sqlalchemy import Column, DateTime, Integer, LargeBinary, MetaData
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import TypeDecorator
 
 
 class Base(object):
@@ -15,6 +16,24 @@ class Base(object):
     )
 
 
+class Float16Array(TypeDecorator):
+    """ Stores a 1-D array as raw float16 bytes (2 bytes per value).
+    """
+
+    impl = LargeBinary
+    dtype = np.float16
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return np.asarray(value, dtype=self.dtype).tobytes()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=self.dtype)
+
+
 DeclarativeBase = declarative_base(cls=Base, metadata=MetaData(schema="rekognizer"))
 
 
@@ -23,4 +42,4 @@ class Enrollment(DeclarativeBase):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, nullable=False)
-    embedding = Column(postgresql.ARRAY(Float()), nullable=False)
+    embedding = Column(Float16Array, nullable=False)
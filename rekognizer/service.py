@@ -2,64 +2,80 @@ import json
 import logging
 from typing import List
 
-import cv2
 import numpy as np
 from kombu import Exchange
 from marshmallow import ValidationError
 from nameko.rpc import rpc, RpcProxy
-from nameko.events import EventDispatcher
+from nameko.events import EventDispatcher, event_handler, BROADCAST
 from nameko.exceptions import BadRequest
 from nameko_sqlalchemy import Database
 from werkzeug.wrappers import Response
 from nameko.messaging import Publisher
+from sqlalchemy import LargeBinary, type_coerce
 
+from rekognizer.dependencies import EnrollmentIndexProvider
 from rekognizer.entrypoints import http
 from rekognizer.exceptions import (
+    ImageDownloadTimeoutException,
+    ImageTooLargeException,
     NoFaceException,
     TooManyFacesException,
     UnknownPersonException,
     UserDisabledException,
 )
-from rekognizer.face_detector import FaceDetector
-from rekognizer.facenet import Facenet
-from rekognizer.models import DeclarativeBase, Enrollment
+from rekognizer.facenet import Facenet, EMBEDDING_SIZE, THRESHOLD
+from rekognizer.models import DeclarativeBase, Enrollment, Float16Array
 from rekognizer.schema import VerifySchema, IdentifySchema
-from rekognizer.utils import read_image, normalize_image, resize_image
+from rekognizer.utils import (
+    read_image_faces,
+    read_images_faces,
+    extract_face,
+    get_face_embeddings,
+)
 
 
 class RekognizerService:
     name = "rekognizer"
 
     db = Database(DeclarativeBase)
+    dispatch = EventDispatcher()
 
     @rpc
     def enroll_user(self, user_id, image_urls):
-        for image_url in image_urls:
-            logging.info(f"Analyzing image {image_url}")
-            image = read_image(image_url)
-            if image.shape[1] > image.shape[0]:
-                image = resize_image(image, width=600)
-            else:
-                image = resize_image(image, height=600)
-            faces = FaceDetector.detect_faces(image)
-            faces_len = len(faces)
+        if len(image_urls) == 0:
+            return
 
-            if faces_len == 0:
-                raise NoFaceException(f"Image doesn't contains face")
-            elif faces_len > 1:
-                raise TooManyFacesException(f"Image contains too many faces")
+        images_faces = read_images_faces(image_urls)
+
+        for image_faces in images_faces:
+            logging.info(f"Analyzing image {image_faces['image_url']}")
+
+            if "embedding" not in image_faces:
+                faces = image_faces["faces"]
+                faces_len = len(faces)
 
-            x, y, width, height = faces[0]["box"]
-            cropped_image_face = image[y : y + height, x : x + width]
-            cropped_image_face = cv2.resize(cropped_image_face, (160, 160))
-            cropped_image_face = normalize_image(cropped_image_face)
+                if faces_len == 0:
+                    raise NoFaceException(f"Image doesn't contains face")
+                elif faces_len > 1:
+                    raise TooManyFacesException(f"Image contains too many faces")
 
-            # Get embedding of image's face
-            logging.info(f"Getting embedding {image_url}")
-            embedding = Facenet.get_embeddings(np.array([cropped_image_face]))[0]
+                image_faces["face"] = extract_face(
+                    image_faces["image"], faces[0]["box"]
+                )
+
+        # Get embeddings of all images' faces at once
+        logging.info(f"Getting embeddings {image_urls}")
+        embeddings = get_face_embeddings(images_faces).tolist()
 
-            with self.db.get_session() as session:
-                session.add(Enrollment(embedding=embedding, user_id=user_id))
+        with self.db.get_session() as session:
+            session.add_all(
+                [
+                    Enrollment(embedding=embedding, user_id=user_id)
+                    for embedding in embeddings
+                ]
+            )
+
+        self.dispatch("user_enrolled", {"user_id": user_id, "embeddings": embeddings})
 
 
 class RekognizerHttpService:
@@ -69,8 +85,25 @@ class RekognizerHttpService:
     dispatch = EventDispatcher()
     user_manager = RpcProxy("user_manager")
     publish = Publisher(exchange=Exchange("rekognizer"))
+    enrollment_index = EnrollmentIndexProvider()
 
-    @http("POST", "/verify", expected_exceptions=(ValidationError, BadRequest))
+    @event_handler(
+        "rekognizer", "user_enrolled", handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_user_enrolled(self, payload):
+        embeddings = payload["embeddings"]
+        self.enrollment_index.add([payload["user_id"]] * len(embeddings), embeddings)
+
+    @http(
+        "POST",
+        "/verify",
+        expected_exceptions=(
+            ValidationError,
+            BadRequest,
+            ImageTooLargeException,
+            ImageDownloadTimeoutException,
+        ),
+    )
     def verify(self, request):
         schema = VerifySchema(strict=True)
 
@@ -89,6 +122,8 @@ class RekognizerHttpService:
         expected_exceptions=(
             ValidationError,
             BadRequest,
+            ImageTooLargeException,
+            ImageDownloadTimeoutException,
             NoFaceException,
             TooManyFacesException,
             UnknownPersonException,
@@ -113,13 +148,14 @@ class RekognizerHttpService:
         result = []
         valid_images = []
 
-        for image_url in image_urls:
-            image = read_image(image_url)
-            if image.shape[1] > image.shape[0]:
-                image = resize_image(image, width=600)
-            else:
-                image = resize_image(image, height=600)
-            faces = FaceDetector.detect_faces(image)
+        # Selfie-style verification often sends images that are already face crops
+        for image_faces in read_images_faces(image_urls, allow_face_crops=True):
+            if "embedding" in image_faces:
+                valid_images.append(image_faces)
+                continue
+
+            image_url = image_faces["image_url"]
+            faces = image_faces["faces"]
             faces_len = len(faces)
 
             if faces_len == 0:
@@ -133,17 +169,12 @@ class RekognizerHttpService:
                 )
                 continue
 
-            x, y, width, height = faces[0]["box"]
-            cropped_image_face = image[y : y + height, x : x + width]
-            cropped_image_face = cv2.resize(cropped_image_face, (160, 160))
-            cropped_image_face = normalize_image(cropped_image_face)
+            image_faces["face"] = extract_face(image_faces["image"], faces[0]["box"])
 
-            valid_images.append({"image_url": image_url, "face": cropped_image_face})
+            valid_images.append(image_faces)
 
         if len(valid_images) > 0:
-            embeddings = Facenet.get_embeddings(
-                np.array([image["face"] for image in valid_images])
-            )
+            embeddings = get_face_embeddings(valid_images)
             similarities = Facenet.get_similarities(embeddings)
             for valid_image, similarity_result in zip(valid_images, similarities):
                 if not similarity_result:
@@ -164,50 +195,48 @@ class RekognizerHttpService:
     def _identify(self, image_url: str):
         logging.info(f"Identifying url: {image_url}")
 
-        image = read_image(image_url)
-        if image.shape[1] > image.shape[0]:
-            image = resize_image(image, width=600)
-        else:
-            image = resize_image(image, height=600)
-        faces = FaceDetector.detect_faces(image)
-        faces_len = len(faces)
+        image_faces = read_image_faces(image_url)
 
-        if faces_len == 0:
-            raise NoFaceException(f"Image doesn't contains face")
-        elif faces_len > 1:
-            raise TooManyFacesException(f"Image contains too many faces")
+        if "embedding" not in image_faces:
+            faces = image_faces["faces"]
+            faces_len = len(faces)
 
-        x, y, width, height = faces[0]["box"]
-        cropped_image_face = image[y : y + height, x : x + width]
-        cropped_image_face = cv2.resize(cropped_image_face, (160, 160))
-        cropped_image_face = normalize_image(cropped_image_face)
+            if faces_len == 0:
+                raise NoFaceException(f"Image doesn't contains face")
+            elif faces_len > 1:
+                raise TooManyFacesException(f"Image contains too many faces")
+
+            image_faces["face"] = extract_face(image_faces["image"], faces[0]["box"])
 
         # Get embedding of image's face
-        embedding = Facenet.get_embeddings(np.array([cropped_image_face]))[0]
+        embedding = get_face_embeddings([image_faces])[0]
 
-        # Get all embeddings from database
-        enrollments = self.db.session.query(Enrollment).all()
+        self.enrollment_index.ensure_loaded(self._get_enrollments)
 
-        if len(enrollments) == 0:
+        if len(self.enrollment_index) == 0:
             raise UnknownPersonException(f"Image has not been identified")
 
-        embeddings = np.array([eb.embedding for eb in enrollments])
-        # Insert embedding at the beginning to compare with other embeddings
-        embeddings = np.insert(embeddings, 0, embedding, axis=0)
+        dist, user_id = self.enrollment_index.search(embedding)
 
-        similarities = Facenet.get_similarities(embeddings)
-        # Remove first element as it will always be True
-        similarities.pop(0)
+        if dist > THRESHOLD:
+            raise UnknownPersonException(f"Image has not been identified")
 
-        try:
-            index = similarities.index(True)
+        user = self.user_manager.get_user(user_id=user_id)
+        if user["is_activated"] is False:
+            raise UserDisabledException(f"User {user['id']} is disabled")
 
-            user = self.user_manager.get_user(user_id=enrollments[index].user_id)
-            if user["is_activated"] is False:
-                raise UserDisabledException(f"User {user['id']} is disabled")
+        self.publish(user, routing_key="identification")
 
-            self.publish(user, routing_key="identification")
+        return user
 
-            return user
-        except ValueError:
-            raise UnknownPersonException(f"Image has not been identified")
+    def _get_enrollments(self):
+        # Fetch raw columns instead of hydrating Enrollment instances, and decode
+        # all embeddings with a single np.frombuffer
+        rows = self.db.session.query(
+            Enrollment.user_id, type_coerce(Enrollment.embedding, LargeBinary)
+        ).all()
+        embeddings = np.frombuffer(
+            b"".join(embedding for _, embedding in rows), dtype=Float16Array.dtype
+        ).reshape(-1, EMBEDDING_SIZE)
+
+        return [user_id for user_id, _ in rows], embeddings
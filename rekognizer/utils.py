@@ -1,53 +1,193 @@
+import hashlib
+from typing import List
+
+import eventlet
 import requests
+from eventlet.queue import Queue
 
 import cv2
 import numpy as np
+from requests.adapters import HTTPAdapter
+
+from rekognizer.cache import embedding_cache
+from rekognizer.exceptions import (
+    ImageDownloadTimeoutException,
+    ImageTooLargeException,
+)
+from rekognizer.face_detector import FaceDetector
+from rekognizer.facenet import Facenet
+
+IMAGE_DOWNLOAD_TIMEOUT = 5
+IMAGE_DOWNLOAD_DEADLINE = 15
+IMAGE_DOWNLOAD_CONCURRENCY = 10
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+FACE_CROP_MAX_SIZE = 250
+FACE_CROP_MIN_SHARPNESS = 100
+
+# Shared session so downloads reuse pooled keep-alive connections
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+
+def download_image(image_url: str) -> bytearray:
+    content = bytearray()
+
+    # The requests timeout only bounds each socket read, the deadline bounds the
+    # whole download so slow-dripping servers can't hold a worker
+    exc = ImageDownloadTimeoutException(f"Image {image_url} took too long to download")
+    with eventlet.Timeout(IMAGE_DOWNLOAD_DEADLINE, exc):
+        # Stream the body so oversized images are rejected before being fully read
+        with session.get(image_url, timeout=IMAGE_DOWNLOAD_TIMEOUT, stream=True) as res:
+            try:
+                content_length = int(res.headers.get("Content-Length"))
+            except (TypeError, ValueError):
+                content_length = None
+            if content_length is not None and content_length > MAX_IMAGE_SIZE:
+                raise ImageTooLargeException(f"Image {image_url} is too large")
+
+            for chunk in res.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE):
+                content += chunk
+                if len(content) > MAX_IMAGE_SIZE:
+                    raise ImageTooLargeException(f"Image {image_url} is too large")
+
+    return content
+
+
+def decode_image(content: bytearray) -> np.array:
+    # Decode straight from the downloaded bytes, without intermediate copies
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    # Return contiguous RGB image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def is_face_crop(image: np.array) -> bool:
+    """ Cheap check for images that are already a tight face crop: small, about
+    square and sharp enough (variance of the Laplacian).
+    """
+    (h, w) = image.shape[:2]
+    if max(h, w) > FACE_CROP_MAX_SIZE or not 0.7 < h / w < 1.3:
+        return False
+
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    return cv2.Laplacian(gray, cv2.CV_64F).var() >= FACE_CROP_MIN_SHARPNESS
+
+
+def load_image(image_url: str, allow_face_crops: bool = False) -> dict:
+    content = download_image(image_url)
+    digest = hashlib.sha256(content).hexdigest()
+
+    embedding = embedding_cache.get(digest)
+    if embedding is not None:
+        # Same image has already been embedded, skip decoding and detection
+        return {"image_url": image_url, "digest": digest, "embedding": embedding}
+
+    image = resize_to_max(decode_image(content))
+    image_faces = {"image_url": image_url, "digest": digest, "image": image}
+
+    if allow_face_crops and is_face_crop(image):
+        # Whole image is the face, skip detection
+        (h, w) = image.shape[:2]
+        image_faces["faces"] = [{"box": [0, 0, w, h]}]
+        image_faces["is_face_crop"] = True
+
+    return image_faces
+
+
+def _load_image_into(loaded: Queue, index: int, image_url: str, allow_face_crops: bool):
+    try:
+        loaded.put((index, load_image(image_url, allow_face_crops), None))
+    except Exception as exc:
+        loaded.put((index, None, exc))
+
+
+def read_images_faces(
+    image_urls: List[str], allow_face_crops: bool = False
+) -> List[dict]:
+    # Downloads are I/O bound, fetch them concurrently on green threads
+    pool = eventlet.GreenPool(IMAGE_DOWNLOAD_CONCURRENCY)
+    loaded = Queue()
+    for index, image_url in enumerate(image_urls):
+        pool.spawn_n(_load_image_into, loaded, index, image_url, allow_face_crops)
+
+    images_faces = [None] * len(image_urls)
+    remaining = len(image_urls)
+
+    while remaining > 0:
+        # Wait for one download, then take every other one that finished while
+        # the previous batch was being detected
+        batch = [loaded.get()]
+        while not loaded.empty():
+            batch.append(loaded.get())
+        remaining -= len(batch)
+
+        for index, image_faces, exc in batch:
+            if exc is not None:
+                raise exc
+            images_faces[index] = image_faces
+
+        # Detection runs in a native thread, remaining downloads keep going
+        to_detect = [
+            image_faces
+            for _, image_faces, _ in batch
+            if "embedding" not in image_faces and "faces" not in image_faces
+        ]
+        if len(to_detect) > 0:
+            faces_batch = FaceDetector.detect_faces_batch(
+                [image_faces["image"] for image_faces in to_detect]
+            )
+            for image_faces, faces in zip(to_detect, faces_batch):
+                image_faces["faces"] = faces
+
+    return images_faces
+
+
+def read_image_faces(image_url: str) -> dict:
+    return read_images_faces([image_url])[0]
+
 
+def get_face_embeddings(face_images: List[dict]) -> np.array:
+    """ Returns the embedding of each cropped `face`, only the ones missing from
+    the cache are sent to Facenet.
+    """
+    missing = [image for image in face_images if "embedding" not in image]
 
-def read_image(image_url: str) -> np.array:
-    res = requests.get(image_url)
-    image = np.asarray(bytearray(res.content), dtype="uint8")
-    image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+    if len(missing) > 0:
+        embeddings = Facenet.get_embeddings(
+            np.array([image["face"] for image in missing])
+        )
+        for image, embedding in zip(missing, embeddings):
+            image["embedding"] = embedding
+            # Only cache embeddings of detected faces, a cache hit skips the
+            # face checks done by enrollment and identification
+            if not image.get("is_face_crop"):
+                embedding_cache.set(image["digest"], embedding)
 
-    # Return RGB image
-    return image[..., ::-1]
+    return np.array([image["embedding"] for image in face_images])
 
 
-def normalize_image(image: np.array):
-    mean = np.mean(image)
-    std = np.std(image)
-    std_adj = np.maximum(std, 1.0 / np.sqrt(image.size))
-    y = np.multiply(np.subtract(image, mean), 1 / std_adj)
+def extract_face(image: np.array, box: List[int], size: int = 160) -> np.array:
+    """ Crops the detected face box and resizes it to the Facenet input size.
+    Normalization is left to `Facenet.get_embeddings`.
+    """
+    x, y, width, height = box
+    # Detector boxes may start slightly outside the image, clamp the start only
+    # so the crop still ends where the box does
+    face = image[max(y, 0) : y + height, max(x, 0) : x + width]
 
-    return y
+    return cv2.resize(face, (size, size))
 
 
-def resize_image(image, width=None, height=None, inter=cv2.INTER_AREA):
-    # initialize the dimensions of the image to be resized and
-    # grab the image size
+def resize_to_max(image: np.array, max_dim: int = 600) -> np.array:
     (h, w) = image.shape[:2]
+    scale = max_dim / max(h, w)
 
-    # if both the width and height are None, then return the
-    # original image
-    if width is None and height is None:
+    # Only downscale, smaller images are already cheap enough to detect on
+    if scale >= 1:
         return image
 
-    # check to see if the width is None
-    if width is None:
-        # calculate the ratio of the height and construct the
-        # dimensions
-        r = height / float(h)
-        dim = (int(w * r), height)
-
-    # otherwise, the height is None
-    else:
-        # calculate the ratio of the width and construct the
-        # dimensions
-        r = width / float(w)
-        dim = (width, int(h * r))
-
-    # resize the image
-    resized = cv2.resize(image, dim, interpolation=inter)
-
-    # return the resized image
-    return resized
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)